@@ -2,8 +2,34 @@ import subprocess
 import sqlite3
 from pathlib import Path
 import re
-import pandas as pd
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Pattern for parsing raw (undecoded) 'scontrol show job' output in a single pass.
+# The word boundary keeps e.g. ArrayJobId= from matching as JobId=.
+_RE_FIELDS = re.compile(rb'\b(JobId|JobState|WorkDir)=(\S+)')
+
+# Job states after which Slurm will not change a job's status again. UNKNOWN is only
+# assigned when Slurm positively reports the job gone, never on a failed query.
+_TERMINAL_STATES = ("COMPLETED", "CANCELLED", "FAILED", "TIMEOUT", "UNKNOWN",
+                    "NODE_FAIL", "OUT_OF_MEMORY", "BOOT_FAIL", "DEADLINE")
+
+# squeue prints array tasks as <base>_<idx> or <base>_[range] and het components as <base>+<offset>
+_RE_BASE_JOBID = re.compile(r'\d+')
+
+
+def _merge_states(states: list) -> str:
+    """Combines the states of a job's array tasks or het components, preferring a live state."""
+    live_states = [state for state in states if state not in _TERMINAL_STATES]
+    if live_states:
+        return "RUNNING" if "RUNNING" in live_states else live_states[0]
+    return states[0] if states else "UNKNOWN"
+
 
 class SlurmManager:
     """
@@ -21,20 +47,39 @@ class SlurmManager:
     - job_table(): Retrieves a DataFrame of jobs, filtered by optional status.
     - cancel_job(): Cancels a job in the Slurm manager.
     - refresh_job_status(): Updates the status of jobs in the database.
+    - refresh(): Alias for refresh_job_status().
+    - close(): Closes the database connection.
     """
 
+    DB_PATH = Path.home() / "slurm_jobs.db"
+
     def __init__(self, parent_dir: str):
         """Initializes the SlurmManager with the specified parent directory."""
         self.parent_dir = Path(parent_dir).absolute()
-        self.DB_PATH = Path.home() / "slurm_jobs.db"
+        self._parent_dir_str = str(self.parent_dir)
         self._init_loggers()
+        # The connection is shared by all threads using this manager; the lock serializes access to it
+        self._lock = threading.Lock()
+        self._conn = self._connect()
         self.init_db()
 
+    def close(self):
+        """Closes the manager's database connection."""
+        if getattr(self, "_conn", None) is None:
+            return
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __del__(self):
+        self.close()
+
     def _init_loggers(self):
         """Private method to initialize local and global loggers."""
         # Local logger
         local_log_file_path = self.parent_dir / ".slurm.log"
-        self.local_logger = self._configure_logger(f"SlurmManager_Local_{self.parent_dir.name}", local_log_file_path)
+        self.local_logger = self._configure_logger(f"SlurmManager_Local_{self._parent_dir_str}", local_log_file_path)
 
         # Global logger
         global_log_file_path = Path.home() / ".global_slurm.log"
@@ -43,7 +88,11 @@ class SlurmManager:
     def _configure_logger(self, name, log_file_path, stream=True):
         """Private method to configure and return a logger."""
         logger = logging.getLogger(name)
+        # Loggers are process-wide; only attach handlers the first time this name is configured
+        if logger.handlers:
+            return logger
         logger.setLevel(logging.INFO)
+        logger.propagate = False
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
         # FileHandler
@@ -59,36 +108,69 @@ class SlurmManager:
 
         return logger
 
+    def _connect(self) -> sqlite3.Connection:
+        """Private method to open a database connection configured for concurrent access."""
+        conn = sqlite3.connect(self.DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        # WAL lets readers and writers proceed concurrently; busy_timeout retries on lock contention
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        return conn
+
     def init_db(self):
         """Initializes the SQLite database."""
-        with sqlite3.connect(self.DB_PATH) as conn:
-            conn.execute('''
+        # Autocommit connection: take the write lock up front so concurrent managers can't
+        # both see the terminal column missing and race to add it
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute('''
                 CREATE TABLE IF NOT EXISTS jobs
-                (id INTEGER PRIMARY KEY, parent_dir TEXT, jobid TEXT, jobname TEXT, status TEXT, workingdir TEXT)
+                (id INTEGER PRIMARY KEY, parent_dir TEXT, jobid TEXT, jobname TEXT, status TEXT, workingdir TEXT,
+                 terminal INTEGER DEFAULT 0)
             ''')
+            # Databases created before the terminal column existed need it added and backfilled
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "terminal" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN terminal INTEGER DEFAULT 0")
+                self._conn.execute(f"UPDATE jobs SET terminal=1 WHERE status IN ({','.join('?' * len(_TERMINAL_STATES))})",
+                                   _TERMINAL_STATES)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_pdir_status ON jobs(parent_dir, status)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_jid_pdir ON jobs(jobid, parent_dir)")
 
     def insert_job(self, jobid: str, db_jobname: str, status: str, workingdir: str):
         """Inserts a new job entry into the database."""
-        with sqlite3.connect(self.DB_PATH) as conn:
-            conn.execute("INSERT INTO jobs (parent_dir, jobid, jobname, status, workingdir) VALUES (?, ?, ?, ?, ?)",
-                        (str(self.parent_dir), jobid, db_jobname, status, workingdir))
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO jobs (parent_dir, jobid, jobname, status, workingdir, terminal) VALUES (?, ?, ?, ?, ?, ?)",
+                        (self._parent_dir_str, jobid, db_jobname, status, workingdir, int(status in _TERMINAL_STATES)))
 
-    def parse_scontrol_output(self, output: str) -> dict:
+    def parse_scontrol_output(self, output: bytes) -> dict:
         """
         Parses the output of the 'scontrol' command to extract job details.
         
         Args:
-        - output (str): The stdout string from the 'scontrol' command.
+        - output (bytes): The raw stdout from the 'scontrol' command.
 
         Returns:
         - dict: A dictionary containing details of the job.
         """
+        # Keep the first occurrence: multi-record output (het jobs, arrays) lists the submitted job first
+        fields = {}
+        for key, value in _RE_FIELDS.findall(output):
+            fields.setdefault(key, value)
         return {
-            "jobid": re.search(r'JobId=(\d+)', output).group(1),
-            "status": re.search(r'JobState=([^\s]+)', output).group(1),
-            "workingdir": re.search(r'WorkDir=([^\s]+)', output).group(1)
+            "jobid": fields[b"JobId"].decode(),
+            "status": fields[b"JobState"].decode(),
+            "workingdir": fields[b"WorkDir"].decode()
         }
 
+    def _existing_statuses(self, workingdir: str) -> set:
+        """Private method to return the stored statuses of relevant jobs from a working directory."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status FROM jobs WHERE parent_dir=? AND workingdir=? AND status IN ('RUNNING', 'PENDING', 'CANCELLED')",
+                (self._parent_dir_str, workingdir)).fetchall()
+        return {status for (status,) in rows}
+
     def submit_job(self, path: str, db_jobname: str, resubmit: bool = False):
         """
         Submits a job to the Slurm workload manager.
@@ -100,48 +182,62 @@ class SlurmManager:
         """
         abs_path = Path(path).absolute()
         
-        # Checking existing jobs
-        existing_jobs = self.job_table()
-        matching_jobs = existing_jobs[existing_jobs['workingdir'] == str(abs_path)]
+        # Checking existing jobs, after updating this directory's live jobs from Slurm
+        with self._lock:
+            rows = self._conn.execute("SELECT jobid FROM jobs WHERE parent_dir=? AND workingdir=? AND terminal=0",
+                                      (self._parent_dir_str, str(abs_path))).fetchall()
+        self._refresh_jobs([jobid for (jobid,) in rows])
+        existing_statuses = self._existing_statuses(str(abs_path))
 
         # If jobs found, act accordingly
-        if not matching_jobs.empty:
-            active_jobs = matching_jobs[matching_jobs['status'].isin(["RUNNING", "PENDING"])]
-            if not active_jobs.empty:
-                if not resubmit:
-                    self.local_logger.warning(f"A job from working directory {abs_path} is already {active_jobs.iloc[0]['status']}")
-                    return
-            elif any(matching_jobs['status'] == "CANCELLED"):
-                self.local_logger.warning(f"A job from working directory {abs_path} was previously cancelled")
+        active_statuses = existing_statuses & {"RUNNING", "PENDING"}
+        if active_statuses:
+            if not resubmit:
+                active_status = "RUNNING" if "RUNNING" in active_statuses else "PENDING"
+                self.local_logger.warning(f"A job from working directory {abs_path} is already {active_status}")
+                return
+        elif "CANCELLED" in existing_statuses:
+            self.local_logger.warning(f"A job from working directory {abs_path} was previously cancelled")
 
         # Submitting job to Slurm
         result = subprocess.run(['sbatch', 'submit.sh'], cwd=abs_path, capture_output=True, text=True)
         match = re.search(r'Submitted batch job (\d+)', result.stdout)
-        jobid = match.group(1) if match else None
+        if result.returncode != 0 or not match:
+            self.local_logger.error(f"Failed to submit job from working directory {abs_path}. Error: {result.stderr}")
+            self.global_logger.error(f"Failed to submit job from working directory {abs_path}. Error: {result.stderr}")
+            return
+        jobid = match.group(1)
 
-        scontrol_result = subprocess.run(['scontrol', '-dd', 'show', 'job', jobid], capture_output=True, text=True)
+        scontrol_result = subprocess.run(['scontrol', 'show', 'job', jobid], capture_output=True)
         job_details = self.parse_scontrol_output(scontrol_result.stdout)
 
         self.insert_job(job_details["jobid"], db_jobname, job_details["status"], job_details["workingdir"])
         self.local_logger.info(f"Submitted job with JobID: {jobid}, JobName for DB: {db_jobname}")
         self.global_logger.info(f"Submitted job with JobID: {jobid} in directory: {abs_path}")
 
-    def job_table(self, status: str = None) -> pd.DataFrame:
+    def job_table(self, status: str = None, refresh: bool = False) -> "pd.DataFrame":
         """
         Retrieves a DataFrame of jobs from the database, optionally filtered by status.
         
         Args:
         - status (str, optional): The status to filter the jobs by. If not specified, all jobs are retrieved.
+        - refresh (bool, optional): Whether to update job statuses from Slurm before reading them. Defaults to False.
 
         Returns:
         - pd.DataFrame: A DataFrame of jobs.
         """
-        self.refresh_job_status()
-        query = f"SELECT * FROM jobs WHERE parent_dir='{str(self.parent_dir)}'"
+        # pandas is slow to import and only needed here
+        import pandas as pd
+
+        if refresh:
+            self.refresh_job_status()
+        query = "SELECT * FROM jobs WHERE parent_dir=?"
+        params = (self._parent_dir_str,)
         if status:
-            query += f" AND status='{status.upper()}'"
-        with sqlite3.connect(self.DB_PATH) as conn:
-            return pd.read_sql_query(query, conn)
+            query += " AND status=?"
+            params += (status.upper(),)
+        with self._lock:
+            return pd.read_sql_query(query, self._conn, params=params)
 
     def cancel_job(self, slurm_jobid: str):
         """
@@ -158,26 +254,81 @@ class SlurmManager:
             self.local_logger.error(f"Failed to cancel SLURM job with SlurmJobID: {slurm_jobid}. Error: {result.stderr}")
             self.global_logger.error(f"Failed to cancel SLURM job with SlurmJobID: {slurm_jobid} from directory: {self.parent_dir}. Error: {result.stderr}")
 
+    def _fetch_status(self, jobid: str) -> tuple:
+        """
+        Private method to query the current Slurm status of a single job via 'squeue'.
+
+        The status is None if squeue failed for any reason other than an unrecognized job ID.
+        """
+        result = subprocess.run(['squeue', '-h', '-j', jobid, '-o', '%T'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            if b"Invalid job id specified" in result.stderr:
+                # Set status to UNKNOWN if job ID is not recognized by Slurm
+                return jobid, "UNKNOWN"
+            return jobid, None
+        # One line per array task or het component
+        states = [line.strip() for line in result.stdout.decode().splitlines() if line.strip()]
+        return jobid, _merge_states(states)
+
+    def _fetch_statuses(self, jobids: list) -> list:
+        """Private method to query the current Slurm status of several jobs with as few 'squeue' calls as possible."""
+        if len(jobids) == 1:
+            # A batch of one is the same squeue call _fetch_status makes; don't run it twice
+            return [self._fetch_status(jobids[0])]
+
+        # One squeue call for all jobs: "<jobid>|<state>" per line, one line per array task or het component
+        ids = ",".join(jobids)
+        result = subprocess.run(['squeue', '-h', '--jobs=' + ids, '-o', '%i|%T'], capture_output=True, text=True)
+        if result.returncode == 0:
+            live_jobs = {}
+            for line in result.stdout.splitlines():
+                fields = line.strip().split('|', 1)
+                match = _RE_BASE_JOBID.match(fields[0])
+                if len(fields) == 2 and match:
+                    live_jobs.setdefault(match.group(0), []).append(fields[1])
+            # Set status to UNKNOWN if job ID is not recognized by Slurm
+            return [(jobid, _merge_states(live_jobs[jobid]) if jobid in live_jobs else "UNKNOWN") for jobid in jobids]
+
+        if "Invalid job id specified" not in result.stderr:
+            # Controller or communication error: per-job queries would fail the same way, only slower
+            return [(jobid, None) for jobid in jobids]
+
+        # Fall back to per-job squeue to isolate the rejected IDs; the calls are I/O-bound so threads overlap them
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return list(executor.map(self._fetch_status, jobids))
+
     def refresh_job_status(self):
         """
         Updates the status of jobs in the SQLite database based on their current status in Slurm.
+
+        Jobs already in a terminal state are skipped. The rest are queried with a single
+        'squeue' call; jobs missing from its output are no longer known to Slurm and are
+        marked UNKNOWN. If Slurm rejects a job ID in the batch, jobs are queried individually, concurrently.
+        A single job is queried directly. Jobs whose status cannot be determined, e.g. because
+        the Slurm controller is unreachable, keep their stored status and stay non-terminal.
         """
-        with sqlite3.connect(self.DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(f"SELECT jobid FROM jobs WHERE parent_dir='{self.parent_dir}'")
-            jobids = cursor.fetchall()
-
-            for (jobid,) in jobids:
-                # Use scontrol to get the job details
-                result = subprocess.run(['scontrol', '-dd', 'show', 'job', jobid], capture_output=True, text=True)
-                if "Invalid job id specified" in result.stderr:
-                    # Set status to UNKNOWN if job ID is not recognized by Slurm
-                    new_status = "UNKNOWN"
-                else:
-                    job_details = self.parse_scontrol_output(result.stdout)
-                    new_status = job_details["status"]
-
-                # Update the job status in the SQLite database
-                cursor.execute("UPDATE jobs SET status=? WHERE jobid=? AND parent_dir=?", (new_status, jobid, str(self.parent_dir)))
-
-            conn.commit()
+        with self._lock:
+            rows = self._conn.execute("SELECT jobid FROM jobs WHERE parent_dir=? AND terminal=0",
+                                      (self._parent_dir_str,)).fetchall()
+        self._refresh_jobs([jobid for (jobid,) in rows])
+
+    def _refresh_jobs(self, jobids: list):
+        """Private method to update the stored status of the given jobs from Slurm."""
+        if not jobids:
+            return
+
+        statuses = self._fetch_statuses(jobids)
+
+        # Leave jobs whose status could not be determined untouched
+        updates = [(new_status, int(new_status in _TERMINAL_STATES), jobid, self._parent_dir_str)
+                   for jobid, new_status in statuses if new_status is not None]
+        if not updates:
+            return
+        # Autocommit connection: open one explicit transaction so all updates share a single commit
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("UPDATE jobs SET status=?, terminal=? WHERE jobid=? AND parent_dir=?", updates)
+
+    def refresh(self):
+        """Updates the status of jobs in the database from Slurm; see refresh_job_status()."""
+        self.refresh_job_status()